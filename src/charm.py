@@ -1,8 +1,14 @@
 #!/usr/bin/env python3
 
 """Subordinate charm for TimescaleDB."""
+import glob
+import logging
+import math
 import os
+import re
 import subprocess
+import time
+from concurrent.futures import ThreadPoolExecutor
 
 # from subprocess import subprocess.PIPE, subprocess.Popen, subprocess.check_call, subprocess.check_output
 from ops.charm import CharmBase
@@ -10,6 +16,8 @@ from ops.framework import StoredState
 from ops.main import main
 from ops.model import ActiveStatus, BlockedStatus, MaintenanceStatus, ModelError, WaitingStatus
 
+logger = logging.getLogger(__name__)
+
 
 class TimescaleDB(CharmBase):
     """Subordinate charm for TimescaleDB."""
@@ -17,15 +25,21 @@ class TimescaleDB(CharmBase):
     _stored = StoredState()
     _debs = ["loader-deb", "tools-deb", "deb"]
     _optional_debs = ["toolkit-deb"]
+    _time_column_types = ["timestamp with time zone", "timestamp without time zone", "date"]
 
     def __init__(self, *args):
         super().__init__(*args)
         self.framework.observe(self.on.install, self._on_install)
         self.framework.observe(self.on.config_changed, self._on_config_changed)
         self.framework.observe(self.on.upgrade_charm, self._on_upgrade_charm)
+        self.framework.observe(self.on.update_status, self._on_update_status)
+        self.framework.observe(self.on.move_chunks_action, self._on_move_chunks_action)
+        self.framework.observe(self.on.bulk_load_action, self._on_bulk_load_action)
         self._stored.set_default(installed=False)
         self._stored.set_default(has_resources=False)
         self._stored.set_default(config={})
+        self._stored.set_default(background_workers=0)
+        self._stored.set_default(background_workers_pending=False)
 
     # Install hook that installs TimescaleDB.
     def _on_install(self, event):
@@ -60,28 +74,36 @@ class TimescaleDB(CharmBase):
             event.defer()
 
     # Config_changed hook that sets up TimescaleDB according to the configuration of the charm.
-    # It will only work if the charm is not set up using resources.
+    # Packages are only set up again if their configuration changed and the charm is not set up
+    # using resources, while tablespaces are set up either way once TimescaleDB is installed.
+    # Tiered hypertables that do not exist yet are reported as waiting, not as a failure.
     def _on_config_changed(self, event):
-        # if we set up from resources, skip the event
-        if self._stored.has_resources:
-            return
-
-        event.framework.model.unit.status = MaintenanceStatus("setting up TimescaleDB per config")
         try:
-            old_config = self._stored.config
-            new_config = self._get_config(event)
-
-            if not old_config or (
-                old_config["apt_repository"] != new_config["apt_repository"]
-                or old_config["apt_key"] != new_config["apt_key"]
+            if not self._stored.has_resources:
+                old_config = self._stored.config
+                new_config = self._get_config(event)
+
+                if old_config != new_config:
+                    event.framework.model.unit.status = MaintenanceStatus(
+                        "setting up TimescaleDB per config"
+                    )
+                    if not old_config or (
+                        old_config["apt_repository"] != new_config["apt_repository"]
+                        or old_config["apt_key"] != new_config["apt_key"]
+                    ):
+                        self._setup_repo(new_config)
+                    self._setup_from_repo(new_config)
+                    self._stored.config = new_config
+
+            status = self._setup_tablespaces() if self._stored.installed else ActiveStatus()
+            if not isinstance(status, ActiveStatus):
+                event.framework.model.unit.status = status
+            elif self._status_startswith(
+                "setting up TimescaleDB per config",
+                "config change failed",
+                "tiered hypertables not found",
             ):
-                self._setup_repo(new_config)
-                self._setup_from_repo(new_config)
-            elif old_config:
-                self._setup_from_repo(new_config)
-
-            self._stored.config = new_config
-            event.framework.model.unit.status = ActiveStatus()
+                event.framework.model.unit.status = ActiveStatus()
         except Exception as e:
             event.framework.model.unit.status = BlockedStatus(f"config change failed: {e}")
             event.defer()
@@ -101,6 +123,77 @@ class TimescaleDB(CharmBase):
             event.framework.model.unit.status = BlockedStatus(f"upgrade failed: {e}")
             event.defer()
 
+    # Update_status hook that sizes the background workers after the scheduled jobs, or resets
+    # them once disabled, and moves old chunks to the cold tablespace, each if enabled by
+    # config. The status is only updated
+    # if it was not set by another hook. Tiered hypertables still missing are looked up again,
+    # so that the hot tablespace is attached to them once they are created.
+    def _on_update_status(self, event):
+        if not self._stored.installed:
+            return
+        if self._status_startswith("tiered hypertables not found"):
+            try:
+                event.framework.model.unit.status = self._setup_tablespaces()
+            except Exception as e:
+                event.framework.model.unit.status = BlockedStatus(f"config change failed: {e}")
+
+        # With both disabled, this only clears the statuses left over from when they were not.
+        config = self.model.config
+        try:
+            status = self._update_background_workers()
+        except Exception as e:
+            status = BlockedStatus(f"background workers sizing failed: {e}")
+        if config.get("tiering-on-update-status"):
+            try:
+                self._move_chunks(
+                    config.get("tiering-older-than", ""),
+                    config.get("tiering-update-status-max-bytes", 0),
+                    config.get("tiering-concurrency", 1),
+                    allow_oversized=False,
+                )
+            except Exception as e:
+                status = BlockedStatus(f"chunk tiering failed: {e}")
+
+        if isinstance(self.unit.status, ActiveStatus) or self._status_startswith(
+            "background workers", "chunk tiering"
+        ):
+            event.framework.model.unit.status = status
+
+    # Action that moves old chunks to the cold tablespace, with the tiering settings from the
+    # configuration as defaults for its parameters.
+    def _on_move_chunks_action(self, event):
+        if not self._stored.installed:
+            event.fail("TimescaleDB is not installed yet")
+            return
+
+        try:
+            result = self._move_chunks(
+                event.params.get("older-than") or self.model.config.get("tiering-older-than", ""),
+                event.params.get("max-bytes") or self.model.config.get("tiering-max-bytes", 0),
+                event.params.get("concurrency") or self.model.config.get("tiering-concurrency", 1),
+                log=event.log,
+            )
+            event.set_results(result)
+        except Exception as e:
+            event.fail(f"chunk tiering failed: {e}")
+
+    # Action that loads CSV/TSV files into a hypertable with timescaledb-parallel-copy,
+    # streaming its progress into the action log.
+    def _on_bulk_load_action(self, event):
+        if not self._stored.installed:
+            event.fail("TimescaleDB is not installed yet")
+            return
+
+        try:
+            event.set_results(self._bulk_load(event.params, event.log))
+        except Exception as e:
+            event.fail(f"bulk load failed: {e}")
+
+    # Helper to check whether the status of the unit was set with one of the given message
+    # prefixes, so that hooks only reset the statuses they own.
+    def _status_startswith(self, *prefixes):
+        return self.unit.status.message.startswith(prefixes)
+
     # Helper to get the configurations of the charm.
     def _get_config(self, event):
         return {
@@ -163,7 +256,7 @@ class TimescaleDB(CharmBase):
 
         if changed:
             subprocess.check_call(["timescaledb-tune", "-yes"])
-            subprocess.check_call(["sudo", "systemctl", "restart", "postgresql"])
+            self._restart_postgresql()
             self._stored.resource_hashes = rh
 
     # Helper to setup the apt repository for TimescaleDB.
@@ -228,7 +321,445 @@ class TimescaleDB(CharmBase):
             subprocess.check_call(["sudo", "apt-get", "install", "-y", tsdb_toolkit])
 
         subprocess.check_call(["timescaledb-tune", "-yes"])
+        self._restart_postgresql()
+
+    # Helper to restart PostgreSQL, which applies any background workers change left pending by
+    # update-status.
+    def _restart_postgresql(self):
         subprocess.check_call(["sudo", "systemctl", "restart", "postgresql"])
+        if self._stored.background_workers_pending:
+            if self._stored.background_workers:
+                logger.info("applied %d background workers", self._stored.background_workers)
+            else:
+                logger.info("applied background workers reset")
+            self._stored.background_workers_pending = False
+
+    # Helper to run a SQL statement through psql as the postgres user, returning its unaligned
+    # output.
+    def _psql(self, sql, database="postgres"):
+        return subprocess.check_output(
+            ["sudo", "-u", "postgres", "psql", "-d", database, "-At", "-v", "ON_ERROR_STOP=1"]
+            + ["-c", sql]
+        ).decode("utf-8")
+
+    # Helper to parse the tablespaces config, formatted as comma separated `name:path` entries.
+    def _get_tablespaces(self):
+        tablespaces = {}
+        for entry in self.model.config.get("tablespaces", "").split(","):
+            if not entry.strip():
+                continue
+            name, _, path = (s.strip() for s in entry.partition(":"))
+            if not name or not path.startswith("/"):
+                raise Exception(f"invalid tablespace: {entry.strip()}")
+            tablespaces[name] = path
+
+        return tablespaces
+
+    # Helper to parse the tiered-hypertables config, formatted as comma separated
+    # `database:schema.table` entries. The schema defaults to public.
+    def _get_tiered_hypertables(self):
+        hypertables = []
+        for entry in self.model.config.get("tiered-hypertables", "").split(","):
+            if not entry.strip():
+                continue
+            database, _, table = (s.strip() for s in entry.partition(":"))
+            schema, _, name = table.rpartition(".")
+            if not database or not name:
+                raise Exception(f"invalid hypertable: {entry.strip()}")
+            hypertables.append((database, schema or "public", name))
+
+        return hypertables
+
+    # Helper to get the type of the column a hypertable is partitioned on first, or an empty
+    # string if the table is not a hypertable.
+    def _get_dimension_type(self, database, schema, table):
+        return self._psql(
+            "SELECT column_type FROM timescaledb_information.dimensions "
+            f"WHERE hypertable_schema = {_quote_literal(schema)} "
+            f"AND hypertable_name = {_quote_literal(table)} AND dimension_number = 1",
+            database,
+        ).strip()
+
+    # Helper to split the tiered hypertables into those that exist and those whose database,
+    # TimescaleDB extension or hypertable does not exist yet, as `database:schema.table`.
+    def _find_tiered_hypertables(self):
+        databases = self._psql("SELECT datname FROM pg_database").split()
+        found = []
+        missing = []
+        for database, schema, table in self._get_tiered_hypertables():
+            if (
+                database in databases
+                and self._psql(
+                    "SELECT 1 FROM pg_extension WHERE extname = 'timescaledb'", database
+                ).strip()
+                and self._get_dimension_type(database, schema, table)
+            ):
+                found.append((database, schema, table))
+            else:
+                missing.append(f"{database}:{schema}.{table}")
+
+        return found, missing
+
+    # Helper to create the configured tablespaces and attach the hot tablespace, if any, to the
+    # tiered hypertables so that new chunks are created in it. Returns the status to report,
+    # waiting if some tiered hypertables do not exist yet to attach the hot tablespace to.
+    def _setup_tablespaces(self):
+        tablespaces = self._get_tablespaces()
+        if not tablespaces:
+            return ActiveStatus()
+
+        existing = self._psql("SELECT spcname FROM pg_tablespace").split()
+        for name, path in tablespaces.items():
+            if name in existing:
+                continue
+            subprocess.check_call(["sudo", "mkdir", "-p", path])
+            subprocess.check_call(["sudo", "chown", "postgres:postgres", path])
+            subprocess.check_call(["sudo", "chmod", "700", path])
+            self._psql(f"CREATE TABLESPACE {_quote_ident(name)} LOCATION {_quote_literal(path)}")
+
+        hot = self.model.config.get("hot-tablespace", "")
+        if not hot:
+            return ActiveStatus()
+        if hot not in tablespaces:
+            raise Exception(f"hot-tablespace not in tablespaces: {hot}")
+        found, missing = self._find_tiered_hypertables()
+        for database, schema, table in found:
+            hypertable = _quote_literal(f"{_quote_ident(schema)}.{_quote_ident(table)}")
+            self._psql(
+                f"SELECT attach_tablespace({_quote_literal(hot)}, {hypertable}, "
+                "if_not_attached => true)",
+                database,
+            )
+
+        if missing:
+            return WaitingStatus(f"tiered hypertables not found: {', '.join(missing)}")
+        return ActiveStatus()
+
+    # Helper to list the chunks of a hypertable that are older than the given interval and not
+    # yet in the cold tablespace, oldest first, with their size in bytes. Only hypertables
+    # partitioned on time are supported, as the chunks of the others have no time range.
+    def _get_chunks_to_move(self, database, schema, table, older_than, cold):
+        column_type = self._get_dimension_type(database, schema, table)
+        if not column_type:
+            raise Exception("not a hypertable")
+        if column_type not in self._time_column_types:
+            raise Exception(f"partitioned on a {column_type} column, not on time")
+
+        out = self._psql(
+            "SELECT format('%I.%I', chunk_schema, chunk_name), "
+            "pg_total_relation_size(format('%I.%I', chunk_schema, chunk_name)::regclass) "
+            "FROM timescaledb_information.chunks "
+            f"WHERE hypertable_schema = {_quote_literal(schema)} "
+            f"AND hypertable_name = {_quote_literal(table)} "
+            f"AND range_end < now() - INTERVAL {_quote_literal(older_than)} "
+            f"AND chunk_tablespace IS DISTINCT FROM {_quote_literal(cold)} "
+            "ORDER BY range_end",
+            database,
+        )
+
+        chunks = []
+        for line in out.splitlines():
+            chunk, _, size = line.rpartition("|")
+            chunks.append((chunk, int(size)))
+
+        return chunks
+
+    # Helper to pick, oldest first, the chunks that fit in what is left of the byte budget of a
+    # run. A chunk larger than the whole budget would otherwise never be moved and hold back
+    # the younger chunks, so it is moved on its own if it is the first of the run and oversized
+    # chunks are allowed, and reported if they are not. Returns the chunks picked and the report
+    # of the oversized chunk held back, if any.
+    def _select_chunks(self, chunks, max_bytes, moved_bytes, allow_oversized, log):
+        selected = []
+        total = moved_bytes
+        for chunk, size in chunks:
+            if total + size <= max_bytes:
+                selected.append((chunk, size))
+                total += size
+                continue
+
+            if size > max_bytes and not selected:
+                if not allow_oversized:
+                    return selected, (
+                        f"{chunk} is {size} bytes, over the byte budget of {max_bytes}, "
+                        "move it with the move-chunks action"
+                    )
+                if not moved_bytes:
+                    log(f"{chunk} is {size} bytes, over the byte budget of {max_bytes}")
+                    selected.append((chunk, size))
+            break
+
+        return selected, None
+
+    # Helper to move the chunks of the tiered hypertables older than the given interval to the
+    # cold tablespace. At most max_bytes are moved per run, with at most concurrency moves in
+    # flight at a time so that the I/O does not starve ingest. A hypertable held back by an
+    # oversized chunk or failed moves does not stop the others, and the error raised at the end
+    # reports the chunks and bytes moved by the run.
+    def _move_chunks(
+        self, older_than, max_bytes, concurrency, log=logger.info, allow_oversized=True
+    ):
+        cold = self.model.config.get("cold-tablespace", "")
+        if not cold:
+            raise Exception("cold-tablespace is not set")
+        if not older_than:
+            raise Exception("tiering-older-than is not set")
+
+        start = time.monotonic()
+        moved_chunks = 0
+        moved_bytes = 0
+        errors = []
+        for database, schema, table in self._get_tiered_hypertables():
+            try:
+                chunks, oversized = self._select_chunks(
+                    self._get_chunks_to_move(database, schema, table, older_than, cold),
+                    max_bytes,
+                    moved_bytes,
+                    allow_oversized,
+                    log,
+                )
+            except Exception as e:
+                errors.append(f"{database}:{schema}.{table}: {e}")
+                continue
+            if oversized:
+                errors.append(oversized)
+
+            def move(chunk, database=database):
+                self._psql(
+                    f"SELECT move_chunk(chunk => {_quote_literal(chunk)}, "
+                    f"destination_tablespace => {_quote_literal(cold)}, "
+                    f"index_destination_tablespace => {_quote_literal(cold)})",
+                    database,
+                )
+
+            with ThreadPoolExecutor(max_workers=max(1, int(concurrency))) as pool:
+                futures = [(pool.submit(move, chunk), chunk, size) for chunk, size in chunks]
+
+            for future, chunk, size in futures:
+                try:
+                    future.result()
+                except Exception as e:
+                    errors.append(f"failed to move {chunk}: {e}")
+                    continue
+                moved_chunks += 1
+                moved_bytes += size
+                log(f"moved {chunk} ({size} bytes) to {cold}")
+
+        if errors:
+            raise Exception(
+                f"{'; '.join(errors)} after moving {moved_chunks} chunks ({moved_bytes} bytes)"
+            )
+
+        return {
+            "chunks-moved": moved_chunks,
+            "bytes-moved": moved_bytes,
+            "duration": round(time.monotonic() - start, 3),
+        }
+
+    # Helper to count, across the databases with TimescaleDB, the databases, the scheduled jobs
+    # expected to run at any given time (from their last run duration over their schedule
+    # interval) and the scheduled jobs overdue by more than their schedule interval.
+    def _get_job_load(self):
+        databases = 0
+        density = 0.0
+        overdue = 0
+        for database in self._psql(
+            "SELECT datname FROM pg_database WHERE datallowconn AND NOT datistemplate"
+        ).split():
+            if not self._psql(
+                "SELECT 1 FROM pg_extension WHERE extname = 'timescaledb'", database
+            ).strip():
+                continue
+
+            out = self._psql(
+                "SELECT coalesce(sum(extract(epoch FROM s.last_run_duration) "
+                "/ nullif(extract(epoch FROM j.schedule_interval), 0)), 0), "
+                "count(*) FILTER (WHERE s.next_start < now() - j.schedule_interval) "
+                "FROM timescaledb_information.jobs j "
+                "LEFT JOIN timescaledb_information.job_stats s ON s.job_id = j.job_id "
+                "WHERE j.scheduled",
+                database,
+            )
+            db_density, _, db_overdue = out.strip().partition("|")
+            databases += 1
+            density += float(db_density)
+            overdue += int(db_overdue)
+
+        return databases, density, overdue
+
+    # Helper to size timescaledb.max_background_workers after the job load: one scheduler per
+    # database plus twice the jobs expected to run concurrently, with at least one worker per
+    # database, within the configured bounds. The settings are written with ALTER SYSTEM and
+    # left pending until the charm next restarts PostgreSQL, rather than restarting it here, or
+    # until they are seen applied after a restart done outside the charm. Returns the status to
+    # report.
+    def _size_background_workers(self):
+        lower = self.model.config.get("min-background-workers", 8)
+        upper = self.model.config.get("max-background-workers", 64)
+        if lower > upper:
+            raise Exception("min-background-workers is greater than max-background-workers")
+
+        databases, density, overdue = self._get_job_load()
+        needed = databases + max(databases, math.ceil(2 * density))
+        workers = min(max(needed, lower), upper)
+
+        if workers != self._stored.background_workers:
+            parallel = int(self._psql("SHOW max_parallel_workers").strip())
+            self._psql(f"ALTER SYSTEM SET timescaledb.max_background_workers = {workers}")
+            self._psql(f"ALTER SYSTEM SET max_worker_processes = {workers + parallel + 3}")
+            self._stored.background_workers = workers
+            self._stored.background_workers_pending = True
+
+        if self._stored.background_workers_pending:
+            running = int(self._psql("SHOW timescaledb.max_background_workers").strip())
+            self._stored.background_workers_pending = running != workers
+
+        if overdue and needed > upper:
+            return BlockedStatus(
+                f"background workers starved: {overdue} jobs overdue, "
+                f"{needed} workers needed over max-background-workers {upper}"
+            )
+        if self._stored.background_workers_pending:
+            if overdue:
+                return BlockedStatus(
+                    f"background workers starved: {overdue} jobs overdue, "
+                    f"restart postgresql to apply {workers} workers"
+                )
+            return ActiveStatus(f"background workers {workers} pending restart")
+        if overdue:
+            return ActiveStatus(f"background workers busy: {overdue} jobs overdue")
+        return ActiveStatus()
+
+    # Helper to size the background workers if auto-background-workers is set, or to reset them
+    # if it was unset since they were last sized. Returns the status to report.
+    def _update_background_workers(self):
+        if self.model.config.get("auto-background-workers"):
+            return self._size_background_workers()
+        if self._stored.background_workers:
+            self._reset_background_workers()
+        return ActiveStatus()
+
+    # Helper to drop the background workers settings written while auto-background-workers was
+    # set, so that the ones from timescaledb-tune apply again. Like a sizing change, the reset
+    # is left pending until PostgreSQL restarts.
+    def _reset_background_workers(self):
+        self._psql("ALTER SYSTEM RESET timescaledb.max_background_workers")
+        self._psql("ALTER SYSTEM RESET max_worker_processes")
+        self._stored.background_workers = 0
+        self._stored.background_workers_pending = True
+
+    # Helper to load the files matching the path param into the table param, one file at a time
+    # with timescaledb-parallel-copy. Each worker holds a client connection, so unless
+    # skip-worker-limit is set, the number of workers is capped by the free connection slots.
+    # If a file fails to load, the error reports the totals loaded until then. Returns the
+    # totals loaded.
+    def _bulk_load(self, params, log):
+        files = sorted(glob.glob(params["path"]))
+        if not files:
+            raise Exception(f"no files match {params['path']}")
+
+        workers = params.get("workers", 4)
+        if not params.get("skip-worker-limit", False):
+            free = int(
+                self._psql(
+                    "SELECT current_setting('max_connections')::int "
+                    "- current_setting('superuser_reserved_connections')::int - count(*) "
+                    "FROM pg_stat_activity WHERE backend_type = 'client backend'",
+                    params["database"],
+                ).strip()
+            )
+            if workers > free:
+                log(f"capping {workers} workers to the {max(1, free)} free connection slots")
+                workers = max(1, free)
+
+        start = time.monotonic()
+        loaded_files = 0
+        rows = 0
+        loaded_bytes = 0
+        for path in files:
+            size = os.path.getsize(path)
+            log(f"loading {path} ({size} bytes) with {workers} workers")
+            try:
+                file_rows = self._parallel_copy(path, params, workers, log)
+            except Exception as e:
+                raise Exception(
+                    f"{e} after loading {loaded_files} files ({rows} rows, {loaded_bytes} bytes)"
+                )
+            loaded_files += 1
+            rows += file_rows
+            loaded_bytes += size
+            log(f"loaded {path}: {file_rows} rows, {loaded_bytes} bytes in total")
+
+        duration = time.monotonic() - start
+        return {
+            "files": loaded_files,
+            "rows": rows,
+            "bytes": loaded_bytes,
+            "workers": workers,
+            "duration": round(duration, 3),
+            "rows-per-second": round(rows / duration, 1) if duration else rows,
+        }
+
+    # Helper to run timescaledb-parallel-copy on a single file as the postgres user, logging its
+    # periodic progress reports. Returns the number of rows copied.
+    def _parallel_copy(self, path, params, workers, log):
+        schema, _, table = params["table"].rpartition(".")
+        # timescaledb-parallel-copy already uses the split character as the COPY delimiter.
+        split = "\t" if params.get("format", "csv") == "tsv" else ","
+
+        cmd = [
+            "sudo",
+            "-u",
+            "postgres",
+            "timescaledb-parallel-copy",
+            "--connection",
+            "host=/var/run/postgresql sslmode=disable",
+            "--db-name",
+            params["database"],
+            "--schema",
+            schema or "public",
+            "--table",
+            table,
+            "--file",
+            path,
+            "--workers",
+            str(workers),
+            "--batch-size",
+            str(params.get("batch-size", 5000)),
+            "--split",
+            split,
+            "--copy-options",
+            "CSV",
+            "--reporting-period",
+            "10s",
+            "--verbose",
+        ]
+        if params.get("skip-header", False):
+            cmd.append("--skip-header")
+
+        rows = None
+        ps = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        for line in ps.stdout:
+            line = line.decode("utf-8").strip()
+            copied = re.match(r"COPY (\d+)", line)
+            if copied:
+                rows = int(copied.group(1))
+            if line:
+                log(line)
+
+        if ps.wait() != 0 or rows is None:
+            raise Exception(f"timescaledb-parallel-copy failed on {path}")
+        return rows
+
+
+# Helper to quote a SQL identifier.
+def _quote_ident(name):
+    return '"' + name.replace('"', '""') + '"'
+
+
+# Helper to quote a SQL string literal.
+def _quote_literal(value):
+    return "'" + value.replace("'", "''") + "'"
 
 
 if __name__ == "__main__":
@@ -0,0 +1,334 @@
+# Copyright 2023 Canonical
+# See LICENSE file for licensing details.
+
+"""Simulated system stand-in for exercising the charm hooks end to end.
+
+The unit tests mock ``subprocess`` call by call, which tells us nothing about how expensive
+a hook is as a whole. ``FakeSystem`` instead answers every command the charm runs (apt,
+dpkg, ``timescaledb-tune``, ``systemctl``, ``lsb_release``, ``psql``, ...) from an in-memory model of
+the machine, while keeping a log of the commands and a simulated wall clock driven by
+configurable per-command latencies.
+"""
+
+import contextlib
+import hashlib
+import io
+import os
+import re
+import subprocess
+from unittest import TestCase
+from unittest.mock import patch
+
+from charm import TimescaleDB
+from ops.model import ActiveStatus
+from ops.testing import Harness
+
+# Simulated latencies, in seconds, of the commands the charm runs.
+DEFAULT_LATENCIES = {
+    "apt-update": 8.0,
+    "apt-install": 4.0,
+    "apt-dist-upgrade": 30.0,
+    "apt-key": 0.5,
+    "dpkg": 3.0,
+    "lsb_release": 0.05,
+    "sha1sum": 0.05,
+    "tee": 0.01,
+    "echo": 0.01,
+    "wget": 0.5,
+    "timescaledb-tune": 1.0,
+    "systemctl-restart": 5.0,
+    "systemctl": 0.2,
+    "mkdir": 0.01,
+    "chown": 0.01,
+    "chmod": 0.01,
+    "psql": 0.05,
+    "move_chunk": 2.0,
+    "timescaledb-parallel-copy": 10.0,
+}
+
+
+class FakeProcess:
+    """Stand-in for a ``subprocess.Popen`` object whose output is known up front."""
+
+    def __init__(self, output, returncode=0):
+        self.stdout = io.BytesIO(output)
+        self.returncode = returncode
+
+    def wait(self):
+        return self.returncode
+
+
+class FakeSystem:
+    """In-memory model of the machine the charm manages.
+
+    Args:
+        release: codename reported by ``lsb_release``.
+        pg_versions: PostgreSQL versions present under ``/var/lib/postgresql``.
+        latencies: overrides for ``DEFAULT_LATENCIES``.
+    """
+
+    def __init__(self, release="focal", pg_versions=(12,), latencies=None):
+        self.release = release
+        self.pg_versions = list(pg_versions)
+        self.latencies = dict(DEFAULT_LATENCIES, **(latencies or {}))
+
+        self.packages = {}
+        self.apt_sources = {}
+        self.apt_keys = []
+        self.postgresql_running = True
+        self.directories = set()
+        self.tablespaces = set()
+        # Hypertables per database, as a map of `schema.table` to the type of their first
+        # dimension.
+        self.hypertables = {}
+        # Chunks per (database, `schema.table`), as (name, size in bytes) tuples.
+        self.chunks = {}
+        self.moved_chunks = []
+        # Chunks whose move_chunk fails.
+        self.failing_chunks = set()
+        # Job load per database with TimescaleDB, as (concurrent jobs, overdue jobs) tuples.
+        self.job_load = {}
+        # Settings from postgresql.conf, as written by timescaledb-tune.
+        self.conf_settings = {
+            "max_parallel_workers": "8",
+            "timescaledb.max_background_workers": "8",
+        }
+        self.settings = dict(self.conf_settings)
+        # Settings written with ALTER SYSTEM, applied on the next restart.
+        self.auto_settings = {}
+        # Arguments of the timescaledb-parallel-copy runs.
+        self.parallel_copies = []
+        # Files that timescaledb-parallel-copy fails to load.
+        self.failing_copies = set()
+        self.free_connections = 100
+
+        self.reset_counters()
+
+    def reset_counters(self):
+        """Forget the commands run so far, keeping the state of the machine."""
+        self.commands = []
+        self.clock = 0.0
+        self.apt_updates = 0
+        self.restarts = 0
+        self.tune_runs = 0
+        self.queries = []
+
+    @property
+    def subprocess_count(self):
+        """Number of processes spawned since the last reset."""
+        return len(self.commands)
+
+    @contextlib.contextmanager
+    def patched(self):
+        """Route the charm's subprocess and filesystem probes to this fake."""
+        real_exists = os.path.exists
+
+        def exists(path):
+            path = str(path)
+            if path == "/var/lib/postgresql":
+                return bool(self.pg_versions)
+            if path.startswith("/var/lib/postgresql/"):
+                return path[len("/var/lib/postgresql/") :] in map(str, self.pg_versions)
+            return real_exists(path)
+
+        with patch("subprocess.check_call", self.check_call), patch(
+            "subprocess.check_output", self.check_output
+        ), patch("subprocess.Popen", self.popen), patch("os.path.exists", exists):
+            yield self
+
+    def check_call(self, args, stdin=None, **kwargs):
+        self._run(args, stdin)
+        return 0
+
+    def check_output(self, args, **kwargs):
+        return self._run(args, None)
+
+    def popen(self, args, stdout=None, **kwargs):
+        try:
+            return FakeProcess(self._run(args, None))
+        except subprocess.CalledProcessError as e:
+            return FakeProcess(e.output, e.returncode)
+
+    def _elapse(self, key, times=1):
+        self.clock += self.latencies[key] * times
+
+    def _run(self, args, stdin):
+        self.commands.append(list(args))
+        if hasattr(stdin, "read"):
+            stdin = stdin.read()
+        argv = list(args)
+        if argv[0] == "sudo":
+            argv = argv[3:] if argv[1] == "-u" else argv[1:]
+        prog, rest = argv[0], argv[1:]
+
+        handler = getattr(self, "_cmd_" + prog.replace("-", "_"), None)
+        if handler is None:
+            raise subprocess.CalledProcessError(127, args, b"", f"{prog}: not found".encode())
+        output = handler(rest, stdin)
+        return output if output is not None else b""
+
+    def _cmd_echo(self, rest, stdin):
+        self._elapse("echo")
+        return (" ".join(rest) + "\n").encode()
+
+    def _cmd_tee(self, rest, stdin):
+        self._elapse("tee")
+        self.apt_sources[rest[0]] = stdin.decode() if stdin else ""
+        return stdin
+
+    def _cmd_lsb_release(self, rest, stdin):
+        self._elapse("lsb_release")
+        return f"{self.release}\n".encode()
+
+    def _cmd_sha1sum(self, rest, stdin):
+        self._elapse("sha1sum")
+        with open(rest[0], "rb") as f:
+            digest = hashlib.sha1(f.read()).hexdigest()
+        return f"{digest}  {rest[0]}\n".encode()
+
+    def _cmd_wget(self, rest, stdin):
+        self._elapse("wget")
+        return f"key from {rest[-1]}".encode()
+
+    def _cmd_apt_key(self, rest, stdin):
+        self._elapse("apt-key")
+        self.apt_keys.append(stdin)
+
+    def _cmd_apt_get(self, rest, stdin):
+        sub = rest[0]
+        if sub == "update":
+            self._elapse("apt-update")
+            self.apt_updates += 1
+        elif sub == "install":
+            pkgs = [p for p in rest[1:] if not p.startswith("-")]
+            self._elapse("apt-install", len(pkgs))
+            for p in pkgs:
+                name, _, version = p.partition("=")
+                self.packages[name] = version or "latest"
+        elif sub == "dist-upgrade":
+            self._elapse("apt-dist-upgrade")
+        else:
+            raise subprocess.CalledProcessError(100, ["apt-get"] + rest)
+
+    def _cmd_dpkg(self, rest, stdin):
+        self._elapse("dpkg")
+        self.packages[os.path.basename(rest[-1])] = "deb"
+
+    def _cmd_timescaledb_tune(self, rest, stdin):
+        self._elapse("timescaledb-tune")
+        self.tune_runs += 1
+
+    def _cmd_systemctl(self, rest, stdin):
+        if rest[0] == "restart":
+            self._elapse("systemctl-restart")
+            self.restarts += 1
+            self.postgresql_running = True
+            self.settings = dict(self.conf_settings, **self.auto_settings)
+        else:
+            self._elapse("systemctl")
+
+    def _cmd_mkdir(self, rest, stdin):
+        self._elapse("mkdir")
+        self.directories.add(rest[-1])
+
+    def _cmd_chown(self, rest, stdin):
+        self._elapse("chown")
+
+    def _cmd_chmod(self, rest, stdin):
+        self._elapse("chmod")
+
+    def _cmd_psql(self, rest, stdin):
+        database = rest[rest.index("-d") + 1]
+        sql = rest[rest.index("-c") + 1]
+        self.queries.append((database, sql))
+
+        if "move_chunk(" in sql:
+            self._elapse("move_chunk")
+            chunk = sql.split("chunk => '", 1)[1].split("'", 1)[0]
+            if chunk in self.failing_chunks:
+                raise subprocess.CalledProcessError(1, ["psql"], b"", b"ERROR: disk full")
+            self.moved_chunks.append(chunk)
+            return b""
+
+        self._elapse("psql")
+        if sql.startswith("CREATE TABLESPACE"):
+            self.tablespaces.add(sql.split('"', 2)[1])
+        elif sql.startswith("ALTER SYSTEM SET"):
+            name, _, value = sql[len("ALTER SYSTEM SET ") :].partition(" = ")
+            self.auto_settings[name] = value
+        elif sql.startswith("ALTER SYSTEM RESET"):
+            self.auto_settings.pop(sql.split()[-1], None)
+        elif sql.startswith("SHOW"):
+            return f"{self.settings[sql.split()[1]]}\n".encode()
+        else:
+            return self._query_catalog(database, sql)
+
+    def _query_catalog(self, database, sql):
+        if "FROM pg_tablespace" in sql:
+            rows = ["pg_default", "pg_global"] + sorted(self.tablespaces)
+        elif "FROM pg_stat_activity" in sql:
+            rows = [self.free_connections]
+        elif "FROM pg_database" in sql:
+            rows = ["postgres"] + self._timescaledb_databases()
+        elif "FROM pg_extension" in sql:
+            rows = [1] if database in self._timescaledb_databases() else []
+        elif "FROM timescaledb_information.jobs" in sql:
+            rows = ["|".join(map(str, self.job_load.get(database, (0, 0))))]
+        elif "FROM timescaledb_information.dimensions" in sql:
+            column_type = self.hypertables.get(database, {}).get(self._hypertable(sql))
+            rows = [column_type] if column_type else []
+        elif "FROM timescaledb_information.chunks" in sql:
+            chunks = self.chunks.get((database, self._hypertable(sql)), [])
+            rows = [f"{name}|{size}" for name, size in chunks if name not in self.moved_chunks]
+        else:
+            rows = []
+        return "".join(f"{row}\n" for row in rows).encode()
+
+    def _timescaledb_databases(self):
+        return sorted(set(self.job_load) | set(self.hypertables))
+
+    def _hypertable(self, sql):
+        schema = re.search(r"hypertable_schema = '([^']*)'", sql).group(1)
+        table = re.search(r"hypertable_name = '([^']*)'", sql).group(1)
+        return f"{schema}.{table}"
+
+    def _cmd_timescaledb_parallel_copy(self, rest, stdin):
+        self._elapse("timescaledb-parallel-copy")
+        flags = ("--verbose", "--skip-header")
+        opts = {}
+        for i, arg in enumerate(rest):
+            if arg.startswith("--"):
+                opts[arg] = True if arg in flags else rest[i + 1]
+        self.parallel_copies.append(opts)
+        if opts["--file"] in self.failing_copies:
+            raise subprocess.CalledProcessError(1, ["timescaledb-parallel-copy"], b"EOF\n")
+
+        with open(opts["--file"]) as f:
+            rows = len(f.read().splitlines()) - ("--skip-header" in rest)
+        return (
+            f"at 10s, row rate {rows / 10:.2f}/sec (period), "
+            f"row rate {rows / 10:.2f}/sec (overall), {rows:E} total rows\n"
+            f"COPY {rows}, took 10s with {opts['--workers']} worker(s)\n"
+        ).encode()
+
+
+class FakeSystemTestCase(TestCase):
+    """Test case running the charm in a ``Harness`` against a fresh ``FakeSystem``."""
+
+    def setUp(self):
+        self.system = FakeSystem()
+        stack = contextlib.ExitStack()
+        self.addCleanup(stack.close)
+        stack.enter_context(self.system.patched())
+
+        self.harness = Harness(TimescaleDB)
+        self.addCleanup(self.harness.cleanup)
+
+    def add_resources(self):
+        for name in ("deb", "loader-deb", "tools-deb"):
+            self.harness.add_resource(name, f"{name}-content")
+
+    def install(self):
+        self.harness.begin()
+        self.harness.charm.on.install.emit()
+        self.assertEqual(self.harness.model.unit.status, ActiveStatus())
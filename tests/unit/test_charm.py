@@ -3,13 +3,16 @@
 #
 # Learn more about testing at: https://juju.is/docs/sdk/testing
 
+import os
 import subprocess
+import tempfile
 from unittest import TestCase
 from unittest.mock import ANY, MagicMock, call, patch
 
 from charm import TimescaleDB
+from fake_system import FakeSystemTestCase
 from ops.model import ActiveStatus, BlockedStatus, WaitingStatus
-from ops.testing import Harness
+from ops.testing import ActionFailed, Harness
 
 
 class TestCharm(TestCase):
@@ -121,24 +124,8 @@ class TestCharm(TestCase):
         harness.charm.on.config_changed.emit()
 
         mock_popen.assert_not_called()
-        mock_exists.assert_has_calls([call("/var/lib/postgresql/12")])
-        mock_check_call.assert_has_calls(
-            [
-                call(["sudo", "apt-get", "update", "-qq"]),
-                call(
-                    [
-                        "sudo",
-                        "apt-get",
-                        "install",
-                        "-y",
-                        "timescaledb-2-postgresql-12",
-                        "timescaledb-2-loader-postgresql-12",
-                    ]
-                ),
-                call(["timescaledb-tune", "-yes"]),
-                call(["sudo", "systemctl", "restart", "postgresql"]),
-            ]
-        )
+        mock_exists.assert_not_called()
+        mock_check_call.assert_not_called()
 
         self.assertEqual(harness.model.unit.status, ActiveStatus())
 
@@ -452,3 +439,539 @@ class TestCharm(TestCase):
             harness.model.unit.status,
             BlockedStatus("installation failed: resource missing: tools-deb"),
         )
+
+
+class TestInstallWithTiering(FakeSystemTestCase):
+    def test_install_before_hypertables(self):
+        """Installs once when the tiered hypertables are configured before they exist."""
+        self.harness.update_config(
+            {
+                "tablespaces": "hot:/srv/nvme/tsdb",
+                "hot-tablespace": "hot",
+                "tiered-hypertables": "tdb:metrics",
+            }
+        )
+        self.install()
+        self.harness.charm.on.config_changed.emit()
+
+        self.assertTrue(self.harness.charm._stored.installed)
+        self.assertEqual(
+            self.harness.model.unit.status,
+            WaitingStatus("tiered hypertables not found: tdb:public.metrics"),
+        )
+        self.harness.charm.on.install.emit()
+        self.assertEqual(self.system.restarts, 1)
+        self.assertEqual(self.system.apt_updates, 2)
+
+
+class TestTiering(FakeSystemTestCase):
+    def setUp(self):
+        super().setUp()
+        self.install()
+
+    def test_setup_tablespaces(self):
+        """Creates the configured tablespaces and attaches the hot one to the hypertables."""
+        self.system.hypertables["tdb"] = {
+            "public.metrics": "timestamp with time zone",
+            "iot.readings": "timestamp with time zone",
+        }
+        self.system.reset_counters()
+        self.harness.update_config(
+            {
+                "tablespaces": "hot:/srv/nvme/tsdb, cold:/srv/bulk/tsdb",
+                "hot-tablespace": "hot",
+                "tiered-hypertables": "tdb:metrics,tdb:iot.readings",
+            }
+        )
+
+        self.assertEqual(self.harness.model.unit.status, ActiveStatus())
+        self.assertEqual(self.system.directories, {"/srv/nvme/tsdb", "/srv/bulk/tsdb"})
+        self.assertEqual(self.system.tablespaces, {"hot", "cold"})
+        self.assertIn(
+            (
+                "tdb",
+                """SELECT attach_tablespace('hot', '"iot"."readings"', if_not_attached => true)""",
+            ),
+            self.system.queries,
+        )
+
+        # Existing tablespaces are not created again.
+        self.system.reset_counters()
+        self.harness.charm.on.config_changed.emit()
+        self.assertFalse([q for _, q in self.system.queries if q.startswith("CREATE")])
+
+    def test_setup_tablespaces_missing_hypertables(self):
+        """Waits for the tiered hypertables that do not exist yet, then attaches to them."""
+        self.harness.update_config(
+            {
+                "tablespaces": "hot:/srv/nvme/tsdb",
+                "hot-tablespace": "hot",
+                "tiered-hypertables": "tdb:metrics,tdb:iot.readings",
+            }
+        )
+        self.assertEqual(
+            self.harness.model.unit.status,
+            WaitingStatus("tiered hypertables not found: tdb:public.metrics, tdb:iot.readings"),
+        )
+
+        self.system.hypertables["tdb"] = {"public.metrics": "timestamp with time zone"}
+        self.harness.charm.on.update_status.emit()
+        self.assertEqual(
+            self.harness.model.unit.status,
+            WaitingStatus("tiered hypertables not found: tdb:iot.readings"),
+        )
+
+        self.system.hypertables["tdb"]["iot.readings"] = "timestamp with time zone"
+        self.harness.charm.on.update_status.emit()
+        self.assertEqual(self.harness.model.unit.status, ActiveStatus())
+        self.assertIn(
+            (
+                "tdb",
+                """SELECT attach_tablespace('hot', '"iot"."readings"', if_not_attached => true)""",
+            ),
+            self.system.queries,
+        )
+
+    def test_config_changed_keeps_other_statuses(self):
+        """Leaves alone the statuses set by other hooks."""
+        self.harness.model.unit.status = BlockedStatus("upgrade failed: dpkg error")
+        self.harness.update_config({"tablespaces": "cold:/srv/bulk/tsdb"})
+
+        self.assertEqual(self.system.tablespaces, {"cold"})
+        self.assertEqual(
+            self.harness.model.unit.status, BlockedStatus("upgrade failed: dpkg error")
+        )
+
+    def test_setup_tablespaces_invalid(self):
+        """Blocks on tablespaces that are not declared with an absolute path."""
+        self.harness.update_config({"tablespaces": "cold:bulk"})
+        self.assertEqual(
+            self.harness.model.unit.status,
+            BlockedStatus("config change failed: invalid tablespace: cold:bulk"),
+        )
+
+    def test_move_chunks_action(self):
+        """Moves old chunks to the cold tablespace, oldest first, within the byte budget."""
+        self.harness.update_config(
+            {
+                "tablespaces": "cold:/srv/bulk/tsdb",
+                "cold-tablespace": "cold",
+                "tiered-hypertables": "tdb:metrics",
+                "tiering-older-than": "30 days",
+                "tiering-max-bytes": 250,
+            }
+        )
+        self.system.hypertables["tdb"] = {"public.metrics": "timestamp with time zone"}
+        self.system.chunks["tdb", "public.metrics"] = [
+            ("_timescaledb_internal._hyper_1_1_chunk", 100),
+            ("_timescaledb_internal._hyper_1_2_chunk", 100),
+            ("_timescaledb_internal._hyper_1_3_chunk", 100),
+        ]
+
+        output = self.harness.run_action("move-chunks", {"concurrency": 2})
+
+        self.assertEqual(output.results, {"chunks-moved": 2, "bytes-moved": 200, "duration": ANY})
+        self.assertIn(
+            "moved _timescaledb_internal._hyper_1_1_chunk (100 bytes) to cold", output.logs
+        )
+        self.assertEqual(
+            sorted(self.system.moved_chunks),
+            ["_timescaledb_internal._hyper_1_1_chunk", "_timescaledb_internal._hyper_1_2_chunk"],
+        )
+
+        # The next run picks up where the budget stopped the previous one.
+        output = self.harness.run_action("move-chunks")
+        self.assertEqual(output.results, {"chunks-moved": 1, "bytes-moved": 100, "duration": ANY})
+
+    def test_move_chunks_oversized(self):
+        """Moves a chunk larger than the byte budget on its own, only from the action."""
+        self.harness.update_config(
+            {
+                "cold-tablespace": "cold",
+                "tiered-hypertables": "tdb:metrics,tdb:iot.readings",
+                "tiering-older-than": "30 days",
+                "tiering-max-bytes": 150,
+                "tiering-update-status-max-bytes": 150,
+                "tiering-on-update-status": True,
+            }
+        )
+        self.system.hypertables["tdb"] = {
+            "public.metrics": "timestamp with time zone",
+            "iot.readings": "timestamp with time zone",
+        }
+        self.system.chunks["tdb", "public.metrics"] = [
+            ("_timescaledb_internal._hyper_1_1_chunk", 200),
+            ("_timescaledb_internal._hyper_1_2_chunk", 100),
+        ]
+        self.system.chunks["tdb", "iot.readings"] = [
+            ("_timescaledb_internal._hyper_2_1_chunk", 50),
+        ]
+
+        # The oversized chunk does not hold back the other hypertables.
+        self.harness.charm.on.update_status.emit()
+        self.assertEqual(
+            self.harness.model.unit.status,
+            BlockedStatus(
+                "chunk tiering failed: _timescaledb_internal._hyper_1_1_chunk is 200 bytes, "
+                "over the byte budget of 150, move it with the move-chunks action "
+                "after moving 1 chunks (50 bytes)"
+            ),
+        )
+        self.assertEqual(self.system.moved_chunks, ["_timescaledb_internal._hyper_2_1_chunk"])
+
+        output = self.harness.run_action("move-chunks")
+        self.assertEqual(output.results, {"chunks-moved": 1, "bytes-moved": 200, "duration": ANY})
+
+        self.harness.charm.on.update_status.emit()
+        self.assertEqual(self.harness.model.unit.status, ActiveStatus())
+        self.assertEqual(
+            self.system.moved_chunks,
+            [
+                "_timescaledb_internal._hyper_2_1_chunk",
+                "_timescaledb_internal._hyper_1_1_chunk",
+                "_timescaledb_internal._hyper_1_2_chunk",
+            ],
+        )
+
+    def test_move_chunks_partial_failure(self):
+        """Keeps moving the chunks of the other hypertables and reports the totals moved."""
+        self.harness.update_config(
+            {
+                "cold-tablespace": "cold",
+                "tiered-hypertables": "tdb:metrics,tdb:iot.readings",
+                "tiering-older-than": "30 days",
+            }
+        )
+        self.system.hypertables["tdb"] = {"public.metrics": "timestamp with time zone"}
+        self.system.chunks["tdb", "public.metrics"] = [
+            ("_timescaledb_internal._hyper_1_1_chunk", 100),
+            ("_timescaledb_internal._hyper_1_2_chunk", 100),
+        ]
+        self.system.hypertables["tdb"]["iot.readings"] = "timestamp with time zone"
+        self.system.chunks["tdb", "iot.readings"] = [
+            ("_timescaledb_internal._hyper_2_1_chunk", 50),
+        ]
+        self.system.failing_chunks.add("_timescaledb_internal._hyper_1_2_chunk")
+
+        with self.assertRaises(ActionFailed) as cm:
+            self.harness.run_action("move-chunks")
+
+        message = cm.exception.message
+        self.assertIn("failed to move _timescaledb_internal._hyper_1_2_chunk", message)
+        self.assertIn("after moving 2 chunks (150 bytes)", message)
+        self.assertIn("_timescaledb_internal._hyper_2_1_chunk", self.system.moved_chunks)
+
+    def test_move_chunks_not_time_partitioned(self):
+        """Reports the tiered hypertables that are missing or not partitioned on time."""
+        self.harness.update_config(
+            {
+                "cold-tablespace": "cold",
+                "tiered-hypertables": "tdb:counters,tdb:missing,tdb:metrics",
+                "tiering-older-than": "30 days",
+            }
+        )
+        self.system.hypertables["tdb"] = {
+            "public.counters": "bigint",
+            "public.metrics": "date",
+        }
+        self.system.chunks["tdb", "public.counters"] = [
+            ("_timescaledb_internal._hyper_1_1_chunk", 100),
+        ]
+        self.system.chunks["tdb", "public.metrics"] = [
+            ("_timescaledb_internal._hyper_2_1_chunk", 100),
+        ]
+
+        with self.assertRaises(ActionFailed) as cm:
+            self.harness.run_action("move-chunks")
+
+        self.assertEqual(
+            cm.exception.message,
+            "chunk tiering failed: "
+            "tdb:public.counters: partitioned on a bigint column, not on time; "
+            "tdb:public.missing: not a hypertable after moving 1 chunks (100 bytes)",
+        )
+        self.assertEqual(self.system.moved_chunks, ["_timescaledb_internal._hyper_2_1_chunk"])
+
+    def test_tiering_disabled_on_update_status(self):
+        """Clears the tiering status once tiering on update-status is disabled."""
+        self.harness.update_config({"tiering-on-update-status": True})
+        self.harness.charm.on.update_status.emit()
+        self.assertEqual(
+            self.harness.model.unit.status,
+            BlockedStatus("chunk tiering failed: cold-tablespace is not set"),
+        )
+
+        self.harness.update_config({"tiering-on-update-status": False})
+        self.system.reset_counters()
+        self.harness.charm.on.update_status.emit()
+        self.assertEqual(self.harness.model.unit.status, ActiveStatus())
+        self.assertEqual(self.system.commands, [])
+
+    def test_move_chunks_on_update_status(self):
+        """Moves chunks on update-status when enabled, and blocks if it cannot."""
+        self.harness.update_config({"tiering-on-update-status": True})
+        self.harness.charm.on.update_status.emit()
+        self.assertEqual(
+            self.harness.model.unit.status,
+            BlockedStatus("chunk tiering failed: cold-tablespace is not set"),
+        )
+
+        # Config-changed leaves the status to the next update-status, which clears it.
+        self.harness.update_config({"cold-tablespace": "cold", "tiering-older-than": "1 day"})
+        self.assertEqual(
+            self.harness.model.unit.status,
+            BlockedStatus("chunk tiering failed: cold-tablespace is not set"),
+        )
+        self.harness.charm.on.update_status.emit()
+        self.assertEqual(self.harness.model.unit.status, ActiveStatus())
+
+
+class TestBackgroundWorkers(FakeSystemTestCase):
+    def setUp(self):
+        super().setUp()
+        self.install()
+        self.harness.update_config({"auto-background-workers": True})
+
+    def test_disabled(self):
+        """Does nothing on update-status unless enabled by config."""
+        self.harness.update_config({"auto-background-workers": False})
+        self.system.reset_counters()
+        self.harness.charm.on.update_status.emit()
+        self.assertEqual(self.system.subprocess_count, 0)
+
+    def test_size_within_bounds(self):
+        """Sizes the workers after the job load and defers the change to the next restart."""
+        self.system.job_load = {"tdb1": (3.2, 0), "tdb2": (0.5, 0)}
+        self.system.reset_counters()
+        self.harness.charm.on.update_status.emit()
+
+        # 2 schedulers plus twice the 3.7 concurrent jobs.
+        self.assertEqual(
+            self.system.auto_settings,
+            {"timescaledb.max_background_workers": "10", "max_worker_processes": "21"},
+        )
+        self.assertEqual(self.system.restarts, 0)
+        self.assertEqual(
+            self.harness.model.unit.status,
+            ActiveStatus("background workers 10 pending restart"),
+        )
+
+        # Tablespace and tiering changes do not restart PostgreSQL, so the change stays pending.
+        self.harness.update_config({"tiering-concurrency": 2})
+        self.harness.charm.on.update_status.emit()
+        self.assertEqual(
+            self.harness.model.unit.status,
+            ActiveStatus("background workers 10 pending restart"),
+        )
+
+        # Setting up the packages again restarts PostgreSQL and applies it.
+        self.harness.update_config({"version": "2.10.1~ubuntu20.04"})
+        self.assertEqual(self.system.restarts, 1)
+        self.assertFalse(self.harness.charm._stored.background_workers_pending)
+        self.assertEqual(self.system.settings["timescaledb.max_background_workers"], "10")
+
+        # The settings are neither written nor checked again while the load is unchanged.
+        self.system.reset_counters()
+        self.harness.charm.on.update_status.emit()
+        self.assertFalse([q for _, q in self.system.queries if q.startswith(("ALTER", "SHOW"))])
+        self.assertEqual(self.harness.model.unit.status, ActiveStatus())
+
+        # Light loads are sized to the lower bound.
+        self.system.job_load = {"tdb1": (0.1, 0)}
+        self.harness.charm.on.update_status.emit()
+        self.assertEqual(self.system.auto_settings["timescaledb.max_background_workers"], "8")
+
+    def test_starved(self):
+        """Blocks when jobs are overdue and need more workers than the upper bound."""
+        self.harness.update_config({"max-background-workers": 12})
+        self.system.job_load = {"tdb1": (10.0, 4)}
+        self.harness.charm.on.update_status.emit()
+
+        self.assertEqual(self.system.auto_settings["timescaledb.max_background_workers"], "12")
+        self.assertEqual(
+            self.harness.model.unit.status,
+            BlockedStatus(
+                "background workers starved: 4 jobs overdue, "
+                "21 workers needed over max-background-workers 12"
+            ),
+        )
+
+
+class TestBackgroundWorkersFromResources(FakeSystemTestCase):
+    def setUp(self):
+        super().setUp()
+        self.add_resources()
+        self.install()
+        self.harness.update_config({"auto-background-workers": True})
+
+    def test_pending_until_restart(self):
+        """Blocks starved jobs on a pending change until a restart applies it."""
+        self.system.job_load = {"tdb1": (5.0, 2)}
+        self.harness.charm.on.update_status.emit()
+        self.assertEqual(
+            self.harness.model.unit.status,
+            BlockedStatus(
+                "background workers starved: 2 jobs overdue, restart postgresql to apply 11 workers"
+            ),
+        )
+
+        # Upgrades with unchanged debs do not restart PostgreSQL.
+        self.harness.charm.on.upgrade_charm.emit()
+        self.assertTrue(self.harness.charm._stored.background_workers_pending)
+
+        # Upgrades with changed debs do.
+        self.harness.charm.model.resources.fetch("deb").write_text("new-deb-content")
+        self.harness.charm.on.upgrade_charm.emit()
+        self.assertFalse(self.harness.charm._stored.background_workers_pending)
+
+        self.system.job_load = {"tdb1": (5.0, 0)}
+        self.harness.charm.on.update_status.emit()
+        self.assertEqual(self.harness.model.unit.status, ActiveStatus())
+
+    def test_disable_after_sizing(self):
+        """Resets the sized settings once disabled, pending until a restart applies it."""
+        self.system.job_load = {"tdb1": (5.0, 2)}
+        self.harness.charm.on.update_status.emit()
+        self.assertIsInstance(self.harness.model.unit.status, BlockedStatus)
+
+        self.harness.update_config({"auto-background-workers": False})
+        self.harness.charm.on.update_status.emit()
+        self.assertEqual(self.system.auto_settings, {})
+        self.assertEqual(self.harness.charm._stored.background_workers, 0)
+        self.assertTrue(self.harness.charm._stored.background_workers_pending)
+        self.assertEqual(self.harness.model.unit.status, ActiveStatus())
+
+        # The reset is applied by the next restart, and not issued again.
+        self.harness.charm.model.resources.fetch("deb").write_text("new-deb-content")
+        self.harness.charm.on.upgrade_charm.emit()
+        self.assertFalse(self.harness.charm._stored.background_workers_pending)
+        self.assertEqual(self.system.settings["timescaledb.max_background_workers"], "8")
+        self.system.reset_counters()
+        self.harness.charm.on.update_status.emit()
+        self.assertEqual(self.system.commands, [])
+
+    def test_applied_by_manual_restart(self):
+        """Notices a pending change applied by a restart done outside the charm."""
+        self.system.job_load = {"tdb1": (5.0, 0)}
+        self.harness.charm.on.update_status.emit()
+        self.assertEqual(
+            self.harness.model.unit.status,
+            ActiveStatus("background workers 11 pending restart"),
+        )
+
+        self.system.settings.update(self.system.auto_settings)
+        self.harness.charm.on.update_status.emit()
+        self.assertFalse(self.harness.charm._stored.background_workers_pending)
+        self.assertEqual(self.harness.model.unit.status, ActiveStatus())
+
+
+class TestBulkLoad(FakeSystemTestCase):
+    def setUp(self):
+        super().setUp()
+        self.install()
+
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+        for i in range(2):
+            with open(os.path.join(self.tmpdir.name, f"metrics-{i}.csv"), "w") as f:
+                f.write("time,value\n" + "2023-01-01T00:00:00Z,1\n" * 10)
+
+    def test_bulk_load(self):
+        """Loads every file matching the glob and reports the totals."""
+        output = self.harness.run_action(
+            "bulk-load",
+            {
+                "path": os.path.join(self.tmpdir.name, "*.csv"),
+                "database": "tdb",
+                "table": "metrics",
+                "skip-header": True,
+                "workers": 16,
+                "batch-size": 1000,
+            },
+        )
+
+        self.assertEqual(
+            output.results,
+            {
+                "files": 2,
+                "rows": 20,
+                "bytes": 2 * 241,
+                "workers": 16,
+                "duration": ANY,
+                "rows-per-second": ANY,
+            },
+        )
+        self.assertEqual(len(self.system.parallel_copies), 2)
+        opts = self.system.parallel_copies[0]
+        self.assertEqual(opts["--db-name"], "tdb")
+        self.assertEqual((opts["--schema"], opts["--table"]), ("public", "metrics"))
+        self.assertEqual((opts["--workers"], opts["--batch-size"]), ("16", "1000"))
+        self.assertEqual((opts["--split"], opts["--copy-options"]), (",", "CSV"))
+        self.assertTrue(opts["--skip-header"])
+        self.assertIn(
+            "at 10s, row rate 1.00/sec (period), row rate 1.00/sec (overall), "
+            "1.000000E+01 total rows",
+            output.logs,
+        )
+
+    def test_bulk_load_worker_limit(self):
+        """Caps the workers by the free connection slots, unless told not to."""
+        self.system.free_connections = 6
+        params = {
+            "path": os.path.join(self.tmpdir.name, "metrics-0.csv"),
+            "database": "tdb",
+            "table": "metrics",
+            "workers": 16,
+        }
+
+        output = self.harness.run_action("bulk-load", params)
+        self.assertEqual(output.results["workers"], 6)
+        self.assertIn("capping 16 workers to the 6 free connection slots", output.logs)
+
+        output = self.harness.run_action("bulk-load", dict(params, **{"skip-worker-limit": True}))
+        self.assertEqual(output.results["workers"], 16)
+
+    def test_bulk_load_tsv(self):
+        """Splits TSV files on tabs without adding a second delimiter to COPY."""
+        self.harness.run_action(
+            "bulk-load",
+            {
+                "path": os.path.join(self.tmpdir.name, "metrics-0.csv"),
+                "database": "tdb",
+                "table": "iot.readings",
+                "format": "tsv",
+            },
+        )
+
+        opts = self.system.parallel_copies[0]
+        self.assertEqual((opts["--schema"], opts["--table"]), ("iot", "readings"))
+        self.assertEqual((opts["--split"], opts["--copy-options"]), ("\t", "CSV"))
+
+    def test_bulk_load_partial_failure(self):
+        """Reports the totals loaded before a file failed to load."""
+        self.system.failing_copies.add(os.path.join(self.tmpdir.name, "metrics-1.csv"))
+        with self.assertRaises(ActionFailed) as cm:
+            self.harness.run_action(
+                "bulk-load",
+                {
+                    "path": os.path.join(self.tmpdir.name, "*.csv"),
+                    "database": "tdb",
+                    "table": "metrics",
+                    "skip-header": True,
+                },
+            )
+
+        self.assertTrue(cm.exception.message.startswith("bulk load failed: "))
+        self.assertTrue(
+            cm.exception.message.endswith("after loading 1 files (10 rows, 241 bytes)")
+        )
+
+    def test_bulk_load_no_files(self):
+        """Fails when no file matches the path."""
+        path = os.path.join(self.tmpdir.name, "*.tsv")
+        with self.assertRaises(ActionFailed) as cm:
+            self.harness.run_action(
+                "bulk-load", {"path": path, "database": "tdb", "table": "metrics"}
+            )
+
+        self.assertEqual(cm.exception.message, f"bulk load failed: no files match {path}")
@@ -0,0 +1,155 @@
+# Copyright 2023 Canonical
+# See LICENSE file for licensing details.
+#
+# Hook cost regression suite. Each scenario runs a hook against the simulated system in
+# fake_system.py and asserts budgets on the number of processes spawned, PostgreSQL
+# restarts and simulated wall-clock time. If a change legitimately makes a hook more
+# expensive, raise the corresponding budget in the same change and say why.
+
+from fake_system import FakeSystemTestCase
+from ops.model import ActiveStatus
+
+# Budgets per scenario: (subprocesses, apt-get updates, postgresql restarts, simulated seconds).
+BUDGETS = {
+    "repo-install": (11, 2, 1, 48.0),
+    "repo-config-changed-noop": (0, 0, 0, 0.0),
+    "repo-config-changed-tiering": (0, 0, 0, 0.0),
+    "repo-config-changed-version": (4, 1, 1, 22.0),
+    "repo-config-changed-repository": (9, 1, 1, 24.0),
+    "repo-upgrade-charm": (2, 1, 0, 38.0),
+    "resources-install": (10, 1, 1, 40.0),
+    "resources-config-changed": (0, 0, 0, 0.0),
+    "resources-upgrade-charm-unchanged": (3, 0, 0, 0.5),
+    "resources-upgrade-charm-changed": (6, 0, 1, 10.0),
+    # update-status runs every interval, with 3 databases of which 2 use TimescaleDB, and 2 old
+    # chunks of 1000 bytes.
+    "update-status-sizing": (10, 0, 0, 0.5),
+    "update-status-sizing-steady": (7, 0, 0, 0.35),
+    # Tiering checks that each hypertable is partitioned on time, with one more query.
+    "update-status-tiering": (4, 0, 0, 4.15),
+    "update-status-sizing-and-tiering": (14, 0, 0, 4.65),
+}
+
+
+class TestHookPerformance(FakeSystemTestCase):
+    def assert_within_budget(self, scenario):
+        max_procs, max_updates, max_restarts, max_seconds = BUDGETS[scenario]
+        system = self.system
+        self.assertIsInstance(self.harness.model.unit.status, ActiveStatus)
+        self.assertLessEqual(
+            system.subprocess_count,
+            max_procs,
+            f"{scenario}: {system.subprocess_count} subprocesses: {system.commands}",
+        )
+        self.assertLessEqual(system.apt_updates, max_updates, f"{scenario}: apt-get updates")
+        self.assertLessEqual(system.restarts, max_restarts, f"{scenario}: postgresql restarts")
+        self.assertLessEqual(system.clock, max_seconds, f"{scenario}: simulated seconds")
+
+    def test_repo_install(self):
+        self.install()
+        self.assert_within_budget("repo-install")
+        self.assertIn("timescaledb-2-postgresql-12", self.system.packages)
+
+    def test_repo_config_changed_noop(self):
+        self.install()
+        self.system.reset_counters()
+        self.harness.charm.on.config_changed.emit()
+        self.assert_within_budget("repo-config-changed-noop")
+
+    def test_repo_config_changed_tiering(self):
+        self.install()
+        self.system.reset_counters()
+        self.harness.update_config({"tiering-concurrency": 2})
+        self.assert_within_budget("repo-config-changed-tiering")
+
+    def test_repo_config_changed_version(self):
+        self.install()
+        self.system.reset_counters()
+        self.harness.update_config({"version": "2.10.1~ubuntu20.04"})
+        self.assert_within_budget("repo-config-changed-version")
+        self.assertEqual(self.system.packages["timescaledb-2-postgresql-12"], "2.10.1~ubuntu20.04")
+
+    def test_repo_config_changed_repository(self):
+        self.install()
+        self.system.reset_counters()
+        self.harness.update_config({"apt-repository": "https://example.com/timescaledb/"})
+        self.assert_within_budget("repo-config-changed-repository")
+        self.assertEqual(
+            self.system.apt_sources["/etc/apt/sources.list.d/timescaledb.list"],
+            "deb https://example.com/timescaledb/ focal main\n",
+        )
+
+    def test_repo_upgrade_charm(self):
+        self.install()
+        self.system.reset_counters()
+        self.harness.charm.on.upgrade_charm.emit()
+        self.assert_within_budget("repo-upgrade-charm")
+
+    def test_resources_install(self):
+        self.add_resources()
+        self.install()
+        self.assert_within_budget("resources-install")
+
+    def test_resources_config_changed(self):
+        self.add_resources()
+        self.install()
+        self.system.reset_counters()
+        self.harness.update_config({"version": "2.10.1~ubuntu20.04"})
+        self.assert_within_budget("resources-config-changed")
+
+    def test_resources_upgrade_charm_unchanged(self):
+        self.add_resources()
+        self.install()
+        self.system.reset_counters()
+        self.harness.charm.on.upgrade_charm.emit()
+        self.assert_within_budget("resources-upgrade-charm-unchanged")
+
+    def test_resources_upgrade_charm_changed(self):
+        self.add_resources()
+        self.install()
+        self.harness.charm.model.resources.fetch("deb").write_text("new-deb-content")
+        self.system.reset_counters()
+        self.harness.charm.on.upgrade_charm.emit()
+        self.assert_within_budget("resources-upgrade-charm-changed")
+
+    def setup_update_status(self, sizing, tiering):
+        self.install()
+        self.system.job_load = {"tdb1": (3.2, 0), "tdb2": (0.5, 0)}
+        self.system.hypertables["tdb1"] = {"public.metrics": "timestamp with time zone"}
+        self.system.chunks["tdb1", "public.metrics"] = [
+            ("_timescaledb_internal._hyper_1_1_chunk", 1000),
+            ("_timescaledb_internal._hyper_1_2_chunk", 1000),
+        ]
+        self.harness.update_config(
+            {
+                "auto-background-workers": sizing,
+                "tiering-on-update-status": tiering,
+                "cold-tablespace": "cold",
+                "tiered-hypertables": "tdb1:metrics",
+                "tiering-older-than": "30 days",
+            }
+        )
+        self.system.reset_counters()
+
+    def test_update_status_sizing(self):
+        self.setup_update_status(sizing=True, tiering=False)
+        self.harness.charm.on.update_status.emit()
+        self.assert_within_budget("update-status-sizing")
+
+    def test_update_status_sizing_steady(self):
+        self.setup_update_status(sizing=True, tiering=False)
+        self.harness.charm.on.update_status.emit()
+        self.system.reset_counters()
+        self.harness.charm.on.update_status.emit()
+        self.assert_within_budget("update-status-sizing-steady")
+
+    def test_update_status_tiering(self):
+        self.setup_update_status(sizing=False, tiering=True)
+        self.harness.charm.on.update_status.emit()
+        self.assert_within_budget("update-status-tiering")
+        self.assertEqual(len(self.system.moved_chunks), 2)
+
+    def test_update_status_sizing_and_tiering(self):
+        self.setup_update_status(sizing=True, tiering=True)
+        self.harness.charm.on.update_status.emit()
+        self.assert_within_budget("update-status-sizing-and-tiering")